@@ -12,10 +12,127 @@ __all__ = ['MRI']
 
 import shapely.geometry as shg
 import shapely.affinity as sha
+import shapely.prepared
+import skimage.draw
 import zarr
+import numcodecs.blosc
+import mmap
+import os
+import functools
+import concurrent.futures
 import pathlib
 import numpy as np
 
+try:
+    import shapely.vectorized
+    _HAVE_SHAPELY_VECTORIZED = True
+except ImportError:
+    _HAVE_SHAPELY_VECTORIZED = False
+
+try:
+    import numba
+    _HAVE_NUMBA = True
+except ImportError:
+    _HAVE_NUMBA = False
+
+
+def _polygon_mask(contour: shg.Polygon, shape: tuple) -> np.ndarray:
+    """Rasterize a polygon into a boolean mask by scan-conversion.
+
+    Fills the exterior ring with skimage.draw.polygon and carves out the
+    interior rings (holes) by XOR-ing their fills. This touches each
+    interior pixel once, instead of running a geometric predicate per pixel.
+
+    Args:
+        contour (shapely.geometry.Polygon): polygon in pixel coordinates
+        shape (tuple): (height, width) of the mask
+
+    Returns:
+        a boolean numpy.ndarray of the given shape
+    """
+    mask = np.zeros(shape, dtype=bool)
+    xs, ys = contour.exterior.coords.xy
+    rr, cc = skimage.draw.polygon(np.asarray(ys), np.asarray(xs), shape=shape)
+    mask[rr, cc] = True
+    for ring in contour.interiors:
+        xs, ys = ring.coords.xy
+        rr, cc = skimage.draw.polygon(np.asarray(ys), np.asarray(xs), shape=shape)
+        mask[rr, cc] ^= True
+
+    return mask
+
+
+if _HAVE_NUMBA:
+    @numba.njit(parallel=True, cache=True, fastmath=True)
+    def _fill_mask(vx: np.ndarray, vy: np.ndarray, out: np.ndarray) -> None:
+        """Toggle in <out> the pixels lying inside the ring (vx, vy).
+
+        Ray-casting (crossing number, PNPOLY) test compiled to native code,
+        parallelized over image rows. XOR-ing into <out> lets the caller
+        combine exterior and interior rings with repeated calls.
+        """
+        H, W = out.shape
+        n = vx.shape[0]
+        for i in numba.prange(H):
+            y = np.float64(i)
+            # prefilter: restrict the tests to the x-extent of the ring on
+            # this scanline (the crossings bound all interior pixels)
+            lo = np.inf
+            hi = -np.inf
+            l = n - 1
+            for k in range(n):
+                if (vy[k] > y) != (vy[l] > y):
+                    x_cross = (vx[l] - vx[k]) * (y - vy[k]) / (vy[l] - vy[k]) + vx[k]
+                    if x_cross < lo:
+                        lo = x_cross
+                    if x_cross > hi:
+                        hi = x_cross
+                l = k
+            if hi < lo:
+                continue  # scanline does not cross the ring
+            j0 = max(0, int(np.floor(lo)))
+            j1 = min(W - 1, int(np.ceil(hi)))
+            for j in range(j0, j1 + 1):
+                x = np.float64(j)
+                inside = False
+                l = n - 1
+                for k in range(n):
+                    if (vy[k] > y) != (vy[l] > y) and \
+                            x < (vx[l] - vx[k]) * (y - vy[k]) / (vy[l] - vy[k]) + vx[k]:
+                        inside = not inside
+                    l = k
+                if inside:
+                    out[i, j] = not out[i, j]
+
+
+def _pnpoly_mask(contour: shg.Polygon, shape: tuple) -> np.ndarray:
+    """Rasterize a polygon into a boolean mask with the Numba ray-casting
+    kernel (_fill_mask), one call per ring. Fallback for when shapely's
+    batch containment API is not available.
+    """
+    mask = np.zeros(shape, dtype=bool)
+    rings = [contour.exterior] + list(contour.interiors)
+    for ring in rings:
+        xs, ys = ring.coords.xy
+        _fill_mask(np.asarray(xs, dtype=np.float64),
+                   np.asarray(ys, dtype=np.float64), mask)
+
+    return mask
+
+
+class _MMapDirectoryStore(zarr.DirectoryStore):
+    """A DirectoryStore serving chunk files as memory-mapped views.
+
+    For uncompressed stores, chunk bytes need no decoding, so mapping the
+    file lets windowed reads pull only the touched pages from the OS cache
+    instead of copying whole chunk files into fresh buffers.
+    """
+
+    @staticmethod
+    def _fromfile(fn):
+        with open(fn, 'rb') as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ))
+
 
 #####
 class MRI(object):
@@ -32,19 +149,63 @@ class MRI(object):
     Attributes:
         _path (Path)
         _pyramid (dict)
+
+    Note:
+        Region reads on compressed levels are dominated by chunk decoding.
+        When preparing pyramids for hot, in-RAM workflows, prefer either no
+        compression (served here via mmap) or a fast Blosc codec, e.g.
+        Blosc(cname='zstd', clevel=1, shuffle=Blosc.BITSHUFFLE).
     """
 
     def __init__(self, path: str):
         self._path = pathlib.Path(path)
 
-        with zarr.open_group(self._path, mode='r') as z:
-            self._pyramid = z.attrs['pyramid']
-
-        self._pyramid_levels = np.zeros((2, len(self._pyramid)), dtype=int)
-        self._downsample_factors = np.zeros((len(self._pyramid)), dtype=int)
-        for p in self._pyramid:
-            self._pyramid_levels[:, p['level']] = [p['width'], p['height']]
-            self._downsample_factors[p['level']] = p['downsample_factor']
+        # let Blosc decode chunks with all available cores
+        numcodecs.blosc.set_nthreads(os.cpu_count())
+
+        # open the group once and keep the handle: reopening on every access
+        # would reparse the store metadata for each region read
+        self._zroot = zarr.open_group(self._path, mode='r')
+        self._pyramid = self._zroot.attrs['pyramid']
+
+        # uncompressed local stores can be served by mmap: chunk reads then
+        # borrow pages from the OS cache instead of copying whole files
+        if isinstance(self._zroot.store, zarr.DirectoryStore) and \
+                self._zroot['0'].compressor is None:
+            self._zroot = zarr.open_group(
+                _MMapDirectoryStore(str(self._path)), mode='r')
+        else:
+            # compressed store: keep recently read chunks in an LRU cache, so
+            # overlapping windows (sliding-window sampling) don't re-read the
+            # same chunks from disk
+            self._zroot = zarr.open_group(
+                zarr.LRUStoreCache(self._zroot.store,
+                                   max_size=512 * 1024 * 1024),
+                mode='r')
+
+        # build the per-level geometry as contiguous int64 arrays, in level order
+        n = len(self._pyramid)
+        by_level = sorted(self._pyramid, key=lambda p: p['level'])
+        self._pyramid_levels = np.array(
+            [[p['width'] for p in by_level],
+             [p['height'] for p in by_level]], dtype=np.int64)
+        self._downsample_factors = np.fromiter(
+            (p['downsample_factor'] for p in by_level), dtype=np.int64, count=n)
+        # all between-level scaling factors, precomputed: level conversion
+        # becomes a table lookup
+        self._scale_table = (self._downsample_factors[:, None] /
+                             self._downsample_factors[None, :]).astype(np.float64)
+
+        # per-level array handles, so region reads skip the group lookup (and
+        # the str() key construction) on every access
+        self._level_arrays = [self._zroot[str(k)] for k in range(self.nlevels)]
+
+        # decoded-chunk cache (per instance): overlapping windows reuse
+        # already decoded chunks instead of paying the decode again
+        self._chunk = functools.lru_cache(maxsize=256)(self._read_chunk)
+
+        # executor for asynchronous (prefetch) reads; created on first use
+        self._executor = None
 
     @property
     def path(self) -> pathlib.Path:
@@ -83,9 +244,7 @@ class MRI(object):
         Returns:
             float
         """
-        f = self._downsample_factors[from_level] / self._downsample_factors[to_level]
-
-        return f
+        return self._scale_table[from_level, to_level]
 
     def convert_px(self, point, from_level, to_level):
         """Convert pixel coordinates of a point from <from_level> to
@@ -108,9 +267,74 @@ class MRI(object):
 
         return x, y
 
+    def convert_px_batch(self, points: np.ndarray, from_level: int, to_level: int) -> np.ndarray:
+        """Convert pixel coordinates of a batch of points from <from_level>
+        to <to_level> in a single vectorized operation.
+
+        Args:
+            points (numpy.ndarray): (N, 2) array of (x, y) coordinates in
+                <from_level> plane
+            from_level (int): original image level
+            to_level (int): destination level
+
+        Returns:
+            a (N, 2) numpy.ndarray of new coordinates - no rounding is applied
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if from_level == to_level:
+            return points  # no conversion is necessary
+
+        return points * self.between_level_scaling_factor(from_level, to_level)
+
+    def _read_chunk(self, level: int, ci: int, cj: int) -> np.ndarray:
+        """Read one chunk (ci, cj) of a pyramid level. The slice is aligned
+        to the chunk grid, so Zarr decodes exactly one chunk. Accessed
+        through the self._chunk LRU cache.
+        """
+        arr = self._level_arrays[level]
+        ch, cw = arr.chunks[0], arr.chunks[1]
+        y0, x0 = ci * ch, cj * cw
+
+        return arr[y0:min(y0 + ch, arr.shape[0]),
+                   x0:min(x0 + cw, arr.shape[1]), ...]
+
+    def _read_window(self, level: int, x0: int, y0: int,
+                     width: int, height: int, as_type=np.uint8,
+                     out: np.ndarray = None) -> np.ndarray:
+        """Read a (validated) window from a pyramid level through the cached
+        array handles. The window is assembled chunk by chunk: each chunk is
+        decoded (at most) once - via the chunk cache - and copied in a single
+        block. If <out> is provided, pixels are written there and <as_type>
+        is ignored.
+        """
+        arr = self._level_arrays[level]
+        ch, cw = arr.chunks[0], arr.chunks[1]
+        if out is None:
+            img = np.empty((height, width) + arr.shape[2:], dtype=arr.dtype)
+        else:
+            img = out
+
+        for ci in range(y0 // ch, (y0 + height - 1) // ch + 1):
+            for cj in range(x0 // cw, (x0 + width - 1) // cw + 1):
+                chunk = self._chunk(level, ci, cj)
+                cy0, cx0 = ci * ch, cj * cw
+                sy0, sy1 = max(y0, cy0), min(y0 + height, cy0 + chunk.shape[0])
+                sx0, sx1 = max(x0, cx0), min(x0 + width, cx0 + chunk.shape[1])
+                np.copyto(img[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0, ...],
+                          chunk[sy0 - cy0:sy1 - cy0, sx0 - cx0:sx1 - cx0, ...])
+
+        if out is not None:
+            return out
+        # the window is already a fresh array; convert only on dtype mismatch
+        if img.dtype != np.dtype(as_type):
+            img = img.astype(as_type, copy=False)
+
+        return img
+
     def get_region_px(self, x0: int, y0: int,
                       width: int, height: int,
-                      level: int = 0, as_type=np.uint8) -> np.array:
+                      level: int = 0, as_type=np.uint8,
+                      out: np.ndarray = None) -> np.array:
         """Read a region from the image source. The region is specified in
             pixel coordinates.
 
@@ -120,6 +344,9 @@ class MRI(object):
                 width, height (long): width and height (in pixels) of the region.
                 level (int): the magnification level to read from
                 as_type: type of the pixels (default numpy.uint8)
+                out (numpy.ndarray): if provided, a preallocated buffer of shape
+                (height, width, nchannels) receiving the pixels; avoids a fresh
+                allocation per call in windowed-read loops
 
             Returns:
                 a numpy.ndarray
@@ -134,10 +361,27 @@ class MRI(object):
                 y0 + height > self.heights[level]:
             raise RuntimeError("region out of layer's extent")
 
-        with zarr.open_group(self.path, mode='r') as zarr_root:
-            img = np.array(zarr_root[str(level)][y0:y0 + height, x0:x0 + width, :], dtype=as_type)
+        return self._read_window(level, x0, y0, width, height,
+                                 as_type=as_type, out=out)
 
-        return img
+    def get_region_px_async(self, x0: int, y0: int,
+                            width: int, height: int,
+                            level: int = 0, as_type=np.uint8,
+                            out: np.ndarray = None) -> concurrent.futures.Future:
+        """Schedule a region read on a background thread and return a Future
+        for its result. Lets a caller iterating over windows (e.g. driven by
+        a SlidingWindowSampler) overlap the decode/copy of the next window
+        with the processing of the current one - chunk decoding and the NumPy
+        copies release the GIL. Arguments are those of get_region_px.
+
+        Returns:
+            a concurrent.futures.Future resolving to the numpy.ndarray
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+        return self._executor.submit(self.get_region_px, x0, y0, width, height,
+                                     level, as_type, out)
 
     def get_plane(self, level: int = 0, as_type=np.uint8) -> np.array:
         """Read a whole plane from the image pyramid and return it as a Numpy array.
@@ -152,8 +396,7 @@ class MRI(object):
         if level < 0 or level >= self.nlevels:
             raise RuntimeError("requested level does not exist")
 
-        with zarr.open_group(self.path, mode='r') as zarr_root:
-            img = np.array(zarr_root[str(level)][...], dtype=as_type)
+        img = np.array(self._level_arrays[level][...], dtype=as_type)
 
         return img
 
@@ -174,24 +417,75 @@ class MRI(object):
         Returns:
             a numpy.ndarray
         """
-        x0, y0, x1, y1 = [int(_z) for _z in contour.bounds]
-        x0, y0 = max(0, x0 - border), max(0, y0 - border)
-        x1, y1 = min(x1 + border, self.extent(level)[0]), \
-                 min(y1 + border, self.extent(level)[1])
+        bounds = np.asarray(contour.bounds, dtype=np.int64)
+        x0, y0 = np.maximum(0, bounds[:2] - border)
+        x1, y1 = np.minimum(bounds[2:] + border, self.extent(level))
         # Shift the annotation such that (0,0) will correspond to (x0, y0)
         contour = sha.translate(contour, -x0, -y0)
 
-        # Read the corresponding region
-        img = self.get_region_px(x0, y0, x1 - x0, y1 - y0, level, as_type=np.uint8)
-
-        # mask out the points outside the contour
-        for i in np.arange(img.shape[0]):
-            # line mask
-            lm = np.zeros((img.shape[1],), dtype=img.dtype)
-            j = [_j for _j in np.arange(img.shape[1]) if shg.Point(_j, i).within(contour)]
-            lm[j] = 1
-            img[i,] = img[i,] * lm
+        width, height = x1 - x0, y1 - y0
+
+        # Rasterize the contour first: with the mask known up front, chunks
+        # lying entirely outside the polygon are never read nor decoded.
+        mask = self._contour_mask(contour, (height, width))
+
+        arr = self._level_arrays[level]
+        ch, cw = arr.chunks[0], arr.chunks[1]
+        img = np.zeros((height, width) + arr.shape[2:], dtype=arr.dtype)
+        for ci in range(y0 // ch, (y0 + height - 1) // ch + 1):
+            for cj in range(x0 // cw, (x0 + width - 1) // cw + 1):
+                cy0, cx0 = ci * ch, cj * cw
+                sy0, sy1 = max(y0, cy0), min(y0 + height, cy0 + ch)
+                sx0, sx1 = max(x0, cx0), min(x0 + width, cx0 + cw)
+                if not mask[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0].any():
+                    continue  # chunk entirely outside the contour
+                chunk = self._chunk(level, ci, cj)
+                np.copyto(img[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0, ...],
+                          chunk[sy0 - cy0:sy1 - cy0, sx0 - cx0:sx1 - cx0, ...])
+
+        # apply the mask in one contiguous pass over img (invert in place to
+        # avoid a temporary for ~mask)
+        np.logical_not(mask, out=mask)
+        img[mask] = 0
+        if img.dtype != np.dtype(as_type):
+            img = img.astype(as_type, copy=False)
 
         return img
 
+    def _contour_mask(self, contour, shape: tuple) -> np.ndarray:
+        """Rasterize a geometry into a boolean mask of the given (height,
+        width), picking the fastest available method: scan-conversion for
+        plain polygons, shapely's vectorized containment for general
+        geometries, the Numba ray-casting kernel, or - as a last resort -
+        per-pixel tests against a prepared geometry.
+        """
+        if isinstance(contour, shg.Polygon):
+            # scan-convert the polygon: no per-pixel geometric predicates
+            return _polygon_mask(contour, shape)
+
+        if _HAVE_SHAPELY_VECTORIZED:
+            # general geometry (e.g. MultiPolygon): test all pixel centers in a
+            # single vectorized call (the geometry is prepared once, at C level)
+            ys, xs = np.mgrid[0:shape[0], 0:shape[1]]
+            return shapely.vectorized.contains(contour, xs.ravel(), ys.ravel()).reshape(shape)
+
+        if _HAVE_NUMBA:
+            # compiled ray-casting kernel, one pass per polygon of the geometry
+            mask = np.zeros(shape, dtype=bool)
+            for poly in getattr(contour, 'geoms', [contour]):
+                mask |= _pnpoly_mask(poly, shape)
+            return mask
+
+        # last resort: per-pixel containment tests; preparing the geometry
+        # once amortizes GEOS' spatial indexing across all the tests
+        prepared = shapely.prepared.prep(contour)
+        mask = np.zeros(shape, dtype=bool)
+        # plain range/int: np.arange would yield np.int64 scalars that GEOS
+        # has to coerce for every Point
+        for i in range(int(shape[0])):
+            j = [_j for _j in range(int(shape[1])) if prepared.contains(shg.Point(_j, i))]
+            mask[i, j] = True
+
+        return mask
+
 ##